@@ -9,16 +9,21 @@ See readme.md for more detailed documentation.
 """
 from __future__ import annotations
 
+import builtins as _builtins
+import contextlib as _contextlib
 import dis
-import inspect
+import operator as _operator
+import sys as _sys
 import warnings
 import weakref
-from typing import Any
+from typing import Any, Callable as _Callable, Iterator as _Iterator
 
 import z3
 
 __all__ = "Solver",
 
+_MISSING = object()
+
 # implemented by object, not reversible
 # (a == b) <-> (b == a)
 COMPARISON_OPS = {
@@ -50,6 +55,23 @@ REVERSIBLE_BIN_OPS = {
 
 BIN_OPS = COMPARISON_OPS | REVERSIBLE_BIN_OPS
 
+# the logical operators are handled separately in `traverse`
+_BIN_OP_FUNCS = {
+    "__eq__": _operator.eq,
+    "__ne__": _operator.ne,
+    "__lt__": _operator.lt,
+    "__le__": _operator.le,
+    "__gt__": _operator.gt,
+    "__ge__": _operator.ge,
+    "__add__": _operator.add,
+    "__sub__": _operator.sub,
+    "__mul__": _operator.mul,
+    "__truediv__": _operator.truediv,
+    "__floordiv__": _operator.floordiv,
+    "__pow__": _operator.pow,
+    "__mod__": _operator.mod,
+}
+
 UNARY_OPS = {
     "__pos__": "+",
     "__neg__": "-",
@@ -57,36 +79,54 @@ UNARY_OPS = {
     "__invert__": "~", # not x
 }
 
-class ValueMeta(type):
-    def __init__(cls, name: str, bases: tuple[type, ...], ns: dict[str, Any]):
-        for attr in BIN_OPS:
-            # default value needs to be used to ensure the right value of attr is used
-            def bin_op(left: Value, right: Any, op: str=attr) -> Binop:
-                # left ns needs to be chosen since right arg can be anything
-                return Binop(left, right, op, ns=left.ns)
-            setattr(cls, attr, bin_op)
-        for attr in REVERSIBLE_BIN_OPS:
-            def rbin_op(left: Value, right: Any, op: str=attr) -> Binop:
-                # left ns needs to be chosen since right arg can be anything
-                return Binop(right, left, op, ns=left.ns)
-            setattr(cls, attr.replace("__", "__r", 1), rbin_op)          
-        for attr in UNARY_OPS:
-            def un_op(arg: Value, op: str=attr) -> Unop:
-                return Unop(arg, op, ns=arg.ns)
-            setattr(cls, attr, un_op)
-
-class Value(metaclass=ValueMeta):
+# the instruction an `assert` uses to test its condition
+# (split into forward and backward variants in python 3.11)
+_POP_JUMP_IF_TRUE = frozenset(
+    dis.opmap[name]
+    for name in ("POP_JUMP_IF_TRUE", "POP_JUMP_FORWARD_IF_TRUE", "POP_JUMP_BACKWARD_IF_TRUE")
+    if name in dis.opmap
+)
+
+def _make_bin_op(op: str):
+    def bin_op(left: Value, right: Any) -> Binop:
+        # left ns needs to be chosen since right arg can be anything
+        return Binop(left, right, op, ns=left.ns)
+    return bin_op
+
+def _make_rbin_op(op: str):
+    def rbin_op(left: Value, right: Any) -> Binop:
+        # left ns needs to be chosen since right arg can be anything
+        return Binop(right, left, op, ns=left.ns)
+    return rbin_op
+
+def _make_un_op(op: str):
+    def un_op(arg: Value) -> Unop:
+        return Unop(arg, op, ns=arg.ns)
+    return un_op
+
+class Value:
+    __slots__ = "ns",
     def __init__(self, *, ns: weakref.ref[Namespace]):
         self.ns = ns
     def __bool__(self):
-        frame = inspect.currentframe().f_back
-        last_op = frame.f_code.co_code[frame.f_lasti]
-        if dis.opname[last_op] != "POP_JUMP_IF_TRUE":
+        frame = _sys._getframe(1)
+        if frame.f_code.co_code[frame.f_lasti] not in _POP_JUMP_IF_TRUE:
             warnings.warn("`__bool__` called on expression outside of assertion!\nUse `~` instead of `not`, `&` instead of `and`, `|` instead of `or`\nChained comparison operators (e.g. `x == y == z`) are also not supported.")
-        self.ns().assertion(self)
+        self.ns()._assertion(self)
         return True
 
+# installed once here, and inherited by every kind of node
+for attr in BIN_OPS:
+    setattr(Value, attr, _make_bin_op(attr))
+for attr in REVERSIBLE_BIN_OPS:
+    setattr(Value, attr.replace("__", "__r", 1), _make_rbin_op(attr))
+for attr in UNARY_OPS:
+    setattr(Value, attr, _make_un_op(attr))
+# module globals are visible from solver bodies, don't leak the loop variable
+del attr
+
 class Unop(Value):
+    __slots__ = "arg", "op"
     def __repr__(self):
         return f"({UNARY_OPS[self.op]}{self.arg})"
     def __init__(self, arg: Value, op: str, **kwargs):
@@ -95,6 +135,7 @@ class Unop(Value):
         super().__init__(**kwargs)
 
 class Binop(Value):
+    __slots__ = "left", "right", "op"
     def __repr__(self):
         return f"({self.left} {BIN_OPS[self.op]} {self.right})"
     def __init__(self, left: Value, right: Value, op: str, **kwargs):
@@ -104,6 +145,7 @@ class Binop(Value):
         super().__init__(**kwargs)
 
 class Call(Value):
+    __slots__ = "fn", "args"
     def __repr__(self):
         return f"({self.fn}({', '.join(map(repr, self.args))}))"
     def __init__(self, fn: Variable, *args: Value, **kwargs):
@@ -112,6 +154,7 @@ class Call(Value):
         super().__init__(**kwargs)
 
 class Variable(Value):
+    __slots__ = "var",
     def __repr__(self):
         return self.var
     def __init__(self, var: str, **kwargs):
@@ -123,122 +166,273 @@ class Variable(Value):
 class Namespace(dict):
     def __init__(self, *args, **kwds):
         self.assertions: list[Value] = []
+        # kept apart from the namespace itself, since that becomes the class dict
+        self.variables: dict[str, Variable] = {}
+        self.ref = weakref.ref(self)
         super().__init__(self, *args, **kwds)
     def __getitem__(self, key: str):
-        try:
-            x = super().__getitem__(key)
-        except KeyError:
-            if key in ("__name__", "__annotations__"):
-                raise KeyError
-            if key in globals():
-                return globals()[key]
-            try:
-                import builtins
-                return getattr(builtins, key)
-            except AttributeError:
-                return Variable(key, ns=weakref.ref(self))
-        else:
+        if dict.__contains__(self, key):
+            return dict.__getitem__(self, key)
+        if key in ("__name__", "__annotations__"):
+            raise KeyError(key)
+        g = globals()
+        if key in g:
+            return g[key]
+        x = getattr(_builtins, key, _MISSING)
+        if x is not _MISSING:
             return x
-    def assertion(self, value: Value):
+        x = self.variables.get(key)
+        if x is None:
+            x = self.variables[key] = Variable(key, ns=self.ref)
+        return x
+    def _assertion(self, value: Value):
         self.assertions.append(value)
 
+class _Scope:
+    # names in a `with MySolver.scope() as s:` block, where `assert s.x > 0`
+    # adds a constraint until the block ends
+    def __init__(self, vars: dict[str, Any], assertion: _Callable[[Value], None]):
+        self._vars = vars
+        self._variables: dict[str, Variable] = {}
+        self._ref = weakref.ref(self)
+        # called by `Value.__bool__`
+        self._assertion = assertion
+    def __getattr__(self, attr: str):
+        if attr not in self._vars:
+            raise AttributeError(attr)
+        x = self._variables.get(attr)
+        if x is None:
+            x = self._variables[attr] = Variable(attr, ns=self._ref)
+        return x
+
+# convert values from a model back into python objects
+def _decode_bool(x: z3.BoolRef) -> bool:
+    return bool(x)
+
+def _decode_int(x: z3.IntNumRef) -> int:
+    return x.as_long()
+
+def _decode_real(x: z3.ArithRef) -> float:
+    if isinstance(x, z3.RatNumRef):
+        return float(x.as_fraction())
+    return float(x.approx().as_fraction())
+
+def _decode_function(x: z3.FuncInterp) -> z3.FuncInterp:
+    return x
+
+_DECODERS = {bool: _decode_bool, int: _decode_int, float: _decode_real}
+
+_SORTS = {bool: z3.BoolSort(), int: z3.IntSort(), float: z3.RealSort()}
+_DECLARATIONS = {bool: z3.Bool, int: z3.Int, float: z3.Real}
+
+# the same declaration in several solvers gets the same z3 object,
+# for as long as some solver is still using it
+_DECLARATION_CACHE: weakref.WeakValueDictionary[tuple, Any] = weakref.WeakValueDictionary()
+
+def _declare(var: str, ann: type):
+    key = var, ann
+    x = _DECLARATION_CACHE.get(key)
+    if x is None:
+        x = _DECLARATION_CACHE[key] = _DECLARATIONS[ann](var)
+    return x
+
+def _declare_function(var: str, in_sort: tuple[type, ...], out_sort: type):
+    key = var, in_sort, out_sort
+    x = _DECLARATION_CACHE.get(key)
+    if x is None:
+        x = _DECLARATION_CACHE[key] = z3.Function(
+            var, *(_SORTS[sort] for sort in in_sort), _SORTS[out_sort]
+        )
+    return x
+
+def _convert(values: list[Value], vars: dict[str, Any]) -> list[Any]:
+    memo = {}
+    terms = []
+    for term in values:
+        term = z3.simplify(traverse(term, vars, memo))
+        # trivial constraints are settled here without bothering the solver
+        if z3.is_true(term):
+            continue
+        assert not z3.is_false(term), "Unsatisfiable constraints!"
+        terms.append(term)
+    return terms
+
+class _SolverMethod:
+    # a method of solver classes, which gives way to a declared variable with the same name
+    def __init__(self, fn: _Callable):
+        self.fn = fn
+    def __set_name__(self, owner: type, name: str):
+        self.name = name
+    def __get__(self, cls: SolverMeta | None, owner: type | None = None):
+        if cls is not None and self.name in cls.__dict__.get("_SolverMeta__vars", ()):
+            return type(cls).__getattr__(cls, self.name)
+        return self.fn.__get__(cls, owner)
+
 class SolverMeta(type):
     @classmethod
     def __prepare__(cls, name: str, bases: tuple[type, ...]) -> Namespace:
         return Namespace()
     def __init__(cls, name: str, bases: tuple[type, ...], ns: Namespace):
-        sorts = {bool: z3.BoolSort(), int: z3.IntSort(), float: z3.RealSort()}
+        # solvers start off as a copy of their parent's solver,
+        # so inherited constraints don't need to be converted and added again
+        # (`Solver` itself provides an empty one to copy)
+        parents = [base for base in bases if isinstance(base, SolverMeta)]
+        if parents and not parents[0].__depth:
+            solver = parents[0].__solver.translate(z3.main_ctx())
+            others = parents[1:]
+        else:
+            # constraints are mostly checked just once, so skip the incremental machinery
+            solver = z3.SimpleSolver()
+            others = parents
+        # a parent inside a `scope` block has temporary constraints pushed on top,
+        # which aren't inherited
+        for parent in others:
+            solver.add(*parent.__solver.assertions()[:parent.__permanent])
         vars = {}
-        try:
-            for var, ann in cls.__annotations__.items():
-                if isinstance(ann, str):
-                    ann = eval(ann)
-                if ann is bool:
-                    vars[var] = z3.Bool(var)
-                elif ann is int:
-                    vars[var] = z3.Int(var)
-                elif ann is float:
-                    vars[var] = z3.Real(var)
-                elif isinstance(ann, dict):
-                    in_sort, out_sort = next(iter(ann.items()))
-                    out_sort = sorts[out_sort]
-                    if isinstance(in_sort, tuple):
-                        in_sort = (sorts[x] for x in in_sort)
-                        vars[var] = z3.Function(var, *in_sort, out_sort)
-                    else:
-                        in_sort = sorts[in_sort]
-                        vars[var] = z3.Function(var, in_sort, out_sort)
-        except:
-            pass
-        solver = z3.Solver()
-        for term in ns.assertions:
-            solver.add(traverse(term, vars))
-        assert solver.check(), "Unsatisfiable constraints!"
-        cls.__model = solver.model()
+        decoders = {}
+        for parent in reversed(parents):
+            vars.update(parent.__vars)
+            decoders.update(parent.__decoders)
+        for var, ann in getattr(cls, "__annotations__", {}).items():
+            if isinstance(ann, str):
+                ann = eval(ann)
+            if isinstance(ann, dict):
+                in_sort, out_sort = next(iter(ann.items()))
+                if not isinstance(in_sort, tuple):
+                    in_sort = in_sort,
+                vars[var] = _declare_function(var, in_sort, out_sort)
+                decoders[var] = _decode_function
+            elif ann in _DECLARATIONS:
+                vars[var] = _declare(var, ann)
+                decoders[var] = _DECODERS[ann]
+        solver.add(*_convert(ns.assertions, vars))
+        cls.__solver = solver
+        # number of `scope` blocks currently open
+        cls.__depth = 0
         cls.__vars = vars
+        cls.__decoders = decoders
+        cls.__permanent = len(solver.assertions())
+        cls.__check()
+
+    def __check(cls):
+        assert cls.__solver.check() == z3.sat, "Unsatisfiable constraints!"
+        cls.__model = cls.__solver.model()
+
+    def __assertion(cls, value: Value):
+        cls.__solver.add(*_convert([value], cls.__vars))
+        cls.__check()
+
+    @_SolverMethod
+    def check_with(cls, condition: _Callable[[_Scope], Value]) -> bool:
+        # checked as an assumption, so neither the solver nor the results change
+        extra = []
+        value = condition(_Scope(cls.__vars, extra.append))
+        memo = {}
+        terms = [traverse(term, cls.__vars, memo) for term in (*extra, value)]
+        return cls.__solver.check(*terms) == z3.sat
+
+    @_SolverMethod
+    @_contextlib.contextmanager
+    def scope(cls) -> _Iterator[_Scope]:
+        # the solver is kept around, so anything it learns carries over between scopes
+        cls.__solver.push()
+        cls.__depth += 1
+        model = cls.__model
+        try:
+            yield _Scope(cls.__vars, cls.__assertion)
+        finally:
+            cls.__solver.pop()
+            cls.__depth -= 1
+            cls.__model = model
 
     def __repr__(self):
         return repr(self.__model)
     
-    def __iter__(self):
-        g = inspect.currentframe().f_back.f_globals
-        for x in self.__vars:
-            g[x] = getattr(self, x)
+    def __iter__(cls):
+        # decoded directly rather than through `__getattr__`, and written all at once
+        values = {}
+        for var, decl in cls.__vars.items():
+            x = cls.__model[decl]
+            if x is None:
+                raise AttributeError(var)
+            values[var] = cls.__decoders[var](x)
+        _sys._getframe(1).f_globals.update(values)
         return iter(()for()in())
 
     def __getattr__(cls, attr):
         try:
             x = cls.__model[cls.__vars[attr]]
-            if isinstance(x, z3.FuncInterp):
-                pass
-            else:
-                if x.sort() == z3.BoolSort():
-                    return bool(x)
-                if x.sort() == z3.IntSort():
-                    return x.as_long()
-                if x.sort() == z3.RealSort():
-                    if isinstance(x, z3.RatNumRef):
-                        return float(x.as_fraction())
-                    return float(x.approx().as_fraction())
-            return x
+            if x is None:
+                raise AttributeError(attr)
+            return cls.__decoders[attr](x)
         except Exception as e:
             raise AttributeError from e
     
-def traverse(value: Value, vars: dict[str, Any]):
-    if isinstance(value, Variable):
-        return vars[value.var]
-    elif isinstance(value, Unop):
-        if value.op == "__invert__":
-            return z3.Not(traverse(value.arg, vars))
-        else:
-            return eval(
-                f"{UNARY_OPS[value.op]} (__arg)",
-                {"__arg": traverse(value.arg, vars)}
-            )
-    elif isinstance(value, Binop):
-        if value.op == "__and__":
-            return z3.And(traverse(value.left, vars), traverse(value.right, vars))
-        elif value.op == "__or__":
-            return z3.Or(traverse(value.left, vars), traverse(value.right, vars))
-        elif value.op == "__xor__":
-            return z3.Xor(traverse(value.left, vars), traverse(value.right, vars))
-        # don't mistake these two by accident
-        elif value.op == "__rshift__":
-            return z3.Implies(traverse(value.left, vars), traverse(value.right, vars))
-        elif value.op == "__lshift__":
-            return z3.Implies(traverse(value.right, vars), traverse(value.left, vars))
+def traverse(value: Value, vars: dict[str, Any], memo: dict[int, Any] | None = None):
+    # shared subexpressions are only converted once
+    # (every node is kept alive by the assertions, so ids are stable)
+    if memo is None:
+        memo = {}
+    # post-order traversal with an explicit stack, so deeply nested
+    # expressions don't run into the recursion limit
+    stack = [(value, False)]
+    out = []
+    while stack:
+        node, visited = stack.pop()
+        if not isinstance(node, Value):
+            out.append(node)
+            continue
+        key = id(node)
+        if not visited:
+            result = memo.get(key)
+            if result is not None:
+                out.append(result)
+            elif isinstance(node, Variable):
+                result = memo[key] = vars[node.var]
+                out.append(result)
+            else:
+                stack.append((node, True))
+                if isinstance(node, Unop):
+                    stack.append((node.arg, False))
+                elif isinstance(node, Binop):
+                    stack.append((node.right, False))
+                    stack.append((node.left, False))
+                else:
+                    stack.extend((arg, False) for arg in reversed(node.args))
+                    stack.append((node.fn, False))
+            continue
+        if isinstance(node, Unop):
+            arg = out.pop()
+            if node.op == "__invert__":
+                result = z3.Not(arg)
+            elif node.op == "__neg__":
+                result = -arg
+            else:
+                result = +arg
+        elif isinstance(node, Binop):
+            right = out.pop()
+            left = out.pop()
+            if node.op == "__and__":
+                result = z3.And(left, right)
+            elif node.op == "__or__":
+                result = z3.Or(left, right)
+            elif node.op == "__xor__":
+                result = z3.Xor(left, right)
+            # don't mistake these two by accident
+            elif node.op == "__rshift__":
+                result = z3.Implies(left, right)
+            elif node.op == "__lshift__":
+                result = z3.Implies(right, left)
+            else:
+                result = _BIN_OP_FUNCS[node.op](left, right)
         else:
-            return eval(
-                f"(__left) {BIN_OPS[value.op]} (__right)",
-                {
-                    "__left": traverse(value.left, vars),
-                    "__right": traverse(value.right, vars),
-                }
-            )
-    elif isinstance(value, Call):
-        return traverse(value.fn, vars)(*(traverse(arg, vars) for arg in value.args))
-    else:
-        return value
+            n = len(node.args) + 1
+            fn, *args = out[-n:]
+            del out[-n:]
+            result = fn(*args)
+        memo[key] = result
+        out.append(result)
+    return out.pop()
 
 class Solver(metaclass=SolverMeta):
     pass